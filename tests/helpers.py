@@ -25,6 +25,7 @@ tests.
 
 import tempfile
 import random
+import mmap
 import itertools
 import hashlib
 import struct
@@ -32,6 +33,12 @@ import sys
 import os
 from bmaptools import BmapHelpers, BmapCopy, TransRead
 
+# Buffer size for the files which the tests open and read or write, the same
+# as 'cp' uses. It is passed positionally to 'tempfile.NamedTemporaryFile()'
+# because the argument is called 'bufsize' in Python 2 and 'buffering' in
+# Python 3.
+BUFSIZE = 128 * 1024
+
 
 def _create_random_sparse_file(file_obj, size):
     """
@@ -258,34 +265,68 @@ def generate_test_files(max_size=4 * 1024 * 1024, directory=None, delete=True):
         file_obj.close()
 
 
+def _hash_local_file(file_obj, hash_obj):
+    """
+    Feed the contents of local uncompressed file object 'file_obj' to hash
+    object 'hash_obj'. The data are hashed straight from the page cache
+    without copying them to python buffers first.
+    """
+
+    if not os.fstat(file_obj.fileno()).st_size:
+        return
+
+    # The file is read from start to end, so ask the kernel for aggressive
+    # read-ahead.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file_obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    hash_obj.update(mapped)
+    mapped.close()
+
+
 def calculate_chksum(file_path):
-    """Calculates checksum for the contents of file 'file_path'."""
+    """
+    Calculates checksum for the contents of file 'file_path'. The argument may
+    also be an already opened file object of a local uncompressed file, in
+    which case the file object is not closed.
+    """
 
-    file_obj = TransRead.TransRead(file_path)
     hash_obj = hashlib.new("sha256")
 
-    chunk_size = 1024 * 1024
+    if hasattr(file_path, "fileno"):
+        _hash_local_file(file_path, hash_obj)
+        return hash_obj.hexdigest()
+
+    file_obj = TransRead.TransRead(file_path)
+
+    if file_obj.compression_type == 'none' and not file_obj.is_url:
+        _hash_local_file(file_obj, hash_obj)
+    else:
+        chunk_size = 1024 * 1024
 
-    while True:
-        chunk = file_obj.read(chunk_size)
-        if not chunk:
-            break
-        hash_obj.update(chunk)
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            hash_obj.update(chunk)
 
     file_obj.close()
     return hash_obj.hexdigest()
 
 
-def copy_and_verify_image(image, dest, bmap, image_chksum, image_size):
+def copy_and_verify_image(image, dest, bmap, image_chksum, image_size,
+                          bufsize=BUFSIZE):
     """
     Copy image 'image' using bmap file 'bmap' to the destination file 'dest'
-    and verify the resulting image checksum.
+    and verify the resulting image checksum. The 'bufsize' argument is the
+    buffer size to open 'dest' and 'bmap' with.
     """
 
     f_image = TransRead.TransRead(image)
-    f_dest = open(dest, "w+b")
+    f_dest = open(dest, "w+b", bufsize)
     if (bmap):
-        f_bmap = open(bmap, "r")
+        f_bmap = open(bmap, "r", bufsize)
     else:
         f_bmap = None
 
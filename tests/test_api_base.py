@@ -19,6 +19,11 @@ This test verifies the base bmap creation and copying API functionality. It
 generates a random sparse file, then creates a bmap fir this file and copies it
 to a different file using the bmap. Then it compares the original random sparse
 file and the copy and verifies that they are identical.
+
+The copying is also tested for compressed versions of the random sparse file.
+Tar archives ('.tar.gz', etc) are only tested when the 'BMAP_TEST_TAR'
+environment variable is set to a non-empty value, because each of them costs
+another compression pass per test file.
 """
 
 # Disable the following pylint recommendations:
@@ -32,8 +37,14 @@ file and the copy and verifies that they are identical.
 import os
 import sys
 import tempfile
-import filecmp
+import itertools
 import subprocess
+import shutil
+import contextlib
+import gzip
+import bz2
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from six.moves import zip_longest
 from tests import helpers
 from bmaptools import BmapHelpers, BmapCreate, Filemap
@@ -44,35 +55,112 @@ try:
 except ImportError:
     import unittest
 
+# The 'lzma' module is only available starting from Python 3.3
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
 
 class Error(Exception):
     """A class for exceptions generated by this test."""
     pass
 
 
+def _unpack_hole(hole):
+    """
+    Unpack hole 'hole' yielded by '_get_holes()' into a '(start, end)' tuple.
+    """
+
+    return (hole >> 64, hole & 0xFFFFFFFFFFFFFFFF)
+
+
+def _get_holes(file_path):
+    """
+    This is a generator which yields all the holes in file 'file_path'. It
+    walks the file with the 'SEEK_HOLE' and 'SEEK_DATA' 'lseek()' options, so
+    no block map has to be built.
+
+    The '(start, end)' byte offsets of a hole are packed into a single integer
+    as 'start << 64 | end', which is cheaper to compare than a tuple. Use
+    '_unpack_hole()' to get the offsets back.
+    """
+
+    # pylint: disable=W0212
+    with open(file_path, "rb") as file_obj:
+        size = os.fstat(file_obj.fileno()).st_size
+        offset = 0
+
+        while offset < size:
+            start = Filemap._lseek(file_obj, offset, Filemap._SEEK_HOLE)
+            if start == -1 or start >= size:
+                break
+
+            end = Filemap._lseek(file_obj, start, Filemap._SEEK_DATA)
+            if end == -1:
+                end = size
+
+            yield start << 64 | end
+            offset = end
+
+
 def _compare_holes(file1, file2):
     """
     Make sure that files 'file1' and 'file2' have holes at the same places.
-    The 'file1' and 'file2' arguments may be full file paths or file objects.
+    The 'file1' and 'file2' arguments are full file paths.
     """
 
-    filemap1 = Filemap.filemap(file1)
-    filemap2 = Filemap.filemap(file2)
+    # Compare all the holes with a single list comparison, which loops in C,
+    # and only look for the mismatching hole if there is one.
+    holes1 = list(_get_holes(file1))
+    holes2 = list(_get_holes(file2))
+    if holes1 == holes2:
+        return
+
+    for hole1, hole2 in zip_longest(holes1, holes2):
+        if hole1 == hole2:
+            continue
+
+        # One of the files may have more holes than the other one, in which
+        # case 'zip_longest()' pads the shorter sequence with 'None'.
+        if hole1 is None:
+            raise Error("file2 has an extra hole %d-%d" % _unpack_hole(hole2))
+        if hole2 is None:
+            raise Error("hole %d-%d is missing in file2" % _unpack_hole(hole1))
+        raise Error("mismatch for hole %d-%d, it is %d-%d in file2"
+                    % (_unpack_hole(hole1) + _unpack_hole(hole2)))
+
+
+# Functions which open a file for writing compressed data the same way the
+# corresponding compressor program does by default
+_COMPRESSION_OPENERS = {
+    "gzip": lambda path: gzip.GzipFile(path, "wb", 6),
+    "bzip2": lambda path: bz2.BZ2File(path, "wb"),
+}
+if lzma:
+    _COMPRESSION_OPENERS["xz"] = lambda path: lzma.LZMAFile(path, "wb")
 
-    iterator1 = filemap1.get_unmapped_ranges(0, filemap1.blocks_cnt)
-    iterator2 = filemap2.get_unmapped_ranges(0, filemap2.blocks_cnt)
+# Cache for '_program_is_available()'
+_PROGRAMS_AVAILABLE = {}
 
-    iterator = zip_longest(iterator1, iterator2)
-    for range1, range2 in iterator:
-        if range1 != range2:
-            raise Error("mismatch for hole %d-%d, it is %d-%d in file2"
-                        % (range1[0], range1[1], range2[0], range2[1]))
+
+def _program_is_available(name):
+    """
+    Same as 'BmapHelpers.program_is_available()', but remembers the result.
+    The same compressors are looked up for every test image, and each lookup
+    walks the entire '$PATH'.
+    """
+
+    if name not in _PROGRAMS_AVAILABLE:
+        _PROGRAMS_AVAILABLE[name] = BmapHelpers.program_is_available(name)
+    return _PROGRAMS_AVAILABLE[name]
 
 
 def _generate_compressed_files(file_path, delete=True):
     """
     This is a generator which yields compressed versions of a file
-    'file_path'.
+    'file_path'. The compressed files are yielded in the order the
+    compressors finish.
 
     The 'delete' argument specifies whether the compressed files that this
     generator yields have to be automatically deleted.
@@ -84,45 +172,171 @@ def _generate_compressed_files(file_path, delete=True):
     # Put the temporary files in the directory with 'file_obj'
     directory = os.path.dirname(file_path)
 
-    compressors = [("bzip2",  None, ".bz2",   "-c -k"),
-                   ("pbzip2", None, ".p.bz2", "-c -k"),
-                   ("gzip",   None, ".gz",    "-c"),
-                   ("pigz",   None, ".p.gz",  "-c -k"),
-                   ("xz",     None, ".xz",    "-c -k"),
-                   ("lzop",   None, ".lzo",   "-c -k"),
-                   ("lz4",    None, ".lz4",   "-c -k"),
-                   ("zstd",   None, ".zst",   ""),
+    # Let the compressors which support multi-threading use all CPUs
+    cpus = multiprocessing.cpu_count()
+
+    compressors = [("bzip2",  None, ".bz2",   ["-c", "-k"]),
+                   ("pbzip2", None, ".p.bz2", ["-c", "-k", "-p%d" % cpus]),
+                   ("gzip",   None, ".gz",    ["-c"]),
+                   ("pigz",   None, ".p.gz",  ["-c", "-k", "-p", str(cpus)]),
+                   ("xz",     None, ".xz",    ["-c", "-k", "-T0"]),
+                   ("lzop",   None, ".lzo",   ["-c", "-k"]),
+                   ("lz4",    None, ".lz4",   ["-c", "-k"]),
+                   ("zstd",   None, ".zst",   ["-c", "-T0"]),
                    # The "-P -C /" trick is used to avoid silly warnings:
                    # "tar: Removing leading `/' from member names"
-                   ("bzip2", "tar", ".tar.bz2", "-c -j -O -P -C /"),
-                   ("gzip",  "tar", ".tar.gz",  "-c -z -O -P -C /"),
-                   ("xz",    "tar", ".tar.xz",  "-c -J -O -P -C /"),
-                   ("lzop",  "tar", ".tar.lzo", "-c --lzo -O -P -C /"),
-                   ("lz4",   "tar", ".tar.lz4", "-c -Ilz4 -O -P -C /"),
-                   ("zstd",  "tar", ".tar.zst", "-c -Izstd -O -P -C /"),
-                   ("zip",   None,  ".zip",     "-q -j -")]
+                   ("bzip2", "tar", ".tar.bz2", ["-c", "-j", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("gzip",  "tar", ".tar.gz",  ["-c", "-z", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("xz",    "tar", ".tar.xz",  ["-c", "-J", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("lzop",  "tar", ".tar.lzo", ["-c", "--lzo", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("lz4",   "tar", ".tar.lz4", ["-c", "-Ilz4", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("zstd",  "tar", ".tar.zst", ["-c", "-Izstd", "-O", "-P",
+                                                 "-C", "/"]),
+                   ("zip",   None,  ".zip",     ["-q", "-j", "-"])]
+
+    def compress(job):
+        """
+        Compress 'file_path' into the temporary file of job 'job' and return
+        the temporary file object.
+        """
+
+        decompressor, archiver, options, tmp_file_obj = job
+
+        if not archiver and decompressor in _COMPRESSION_OPENERS:
+            # Compress in-process with the same library the compressor program
+            # uses, which saves a fork and exec.
+            opener = _COMPRESSION_OPENERS[decompressor]
+            f_compressed = opener(tmp_file_obj.name)
+            with open(file_path, "rb") as f_src:
+                shutil.copyfileobj(f_src, f_compressed, 1024 * 1024)
+            f_compressed.close()
+            return tmp_file_obj
 
+        # Run the compressor directly, without the shell in between, and fail
+        # the test if it fails
+        if archiver:
+            args = [archiver] + options + [file_path]
+        else:
+            args = [decompressor] + options + [file_path]
+        subprocess.check_call(args, stdout=tmp_file_obj)
+        return tmp_file_obj
+
+    # Tar archives are tested only on request, see the module docstring
+    test_tar = os.environ.get("BMAP_TEST_TAR")
+
+    jobs = []
     for decompressor, archiver, suffix, options in compressors:
-        if not BmapHelpers.program_is_available(decompressor):
+        if archiver == "tar" and not test_tar:
             continue
-        if archiver and not BmapHelpers.program_is_available(archiver):
+        if not _program_is_available(decompressor):
+            continue
+        if archiver and not _program_is_available(archiver):
             continue
 
         tmp_file_obj = tempfile.NamedTemporaryFile('wb+', prefix=prefix,
                                                    delete=delete, dir=directory,
                                                    suffix=suffix)
+        jobs.append((decompressor, archiver, options, tmp_file_obj))
+
+    if not jobs:
+        return
+
+    # Run all the compressors at once and yield the compressed files in the
+    # order they become ready, so that the total time is about the time of the
+    # slowest compressor rather than the sum of all of them.
+    # Temporary files which have not been yielded yet
+    pending = [job[3] for job in jobs]
+
+    pool = ThreadPool(len(jobs))
+    try:
+        for tmp_file_obj in pool.imap_unordered(compress, jobs):
+            pending.remove(tmp_file_obj)
+            yield tmp_file_obj.name
+            tmp_file_obj.close()
+    finally:
+        pool.close()
+        pool.join()
+
+        # If a compressor failed, the files which were not yielded would stay
+        # around, so remove them. The yielded ones belong to the caller.
+        for job in jobs:
+            job[3].close()
+        if not delete:
+            for tmp_file_obj in pending:
+                os.remove(tmp_file_obj.name)
+
+
+def _verify_compressed_files(image, bmap, image_chksum, image_size,
+                             delete=True):
+    """
+    Compress file 'image' with all the available compressors, then copy each
+    compressed file with and without bmap file 'bmap' and verify the copy.
+    The compressed files are independent, so they are verified in parallel,
+    each in its own thread and with its own temporary file for the copy.
+
+    The 'image_chksum' and 'image_size' arguments are the checksum and size of
+    the image. The 'delete' argument specifies whether the temporary files
+    that this function creates have to be automatically deleted.
+    """
+
+    prefix = os.path.splitext(os.path.basename(image))[0] + '.'
+    directory = os.path.dirname(image)
+
+    def verify(compressed):
+        """Copy and verify compressed file 'compressed'."""
+
+        f_copy = tempfile.NamedTemporaryFile("wb+", helpers.BUFSIZE,
+                                             prefix=prefix, delete=delete,
+                                             dir=directory, suffix=".copy")
+
+        # Test with and without the bmap and with and without setting the
+        # size. The "file:" prefix makes BmapCopy use urllib.
+        iterator = itertools.product([compressed, "file:" + compressed],
+                                     [bmap, None], [image_size, None])
+        for source, source_bmap, source_size in iterator:
+            helpers.copy_and_verify_image(source, f_copy.name, source_bmap,
+                                          image_chksum, source_size)
+
+        f_copy.close()
+
+    # The compressed files have to exist while the threads are using them, so
+    # do not let the generator delete them and remove them ourselves instead.
+    # Collect the names inside the 'try' block, so that the files yielded
+    # before a compressor failure are removed too.
+    compressed_files = []
+
+    pool = ThreadPool(multiprocessing.cpu_count())
+    try:
+        for compressed in _generate_compressed_files(image, delete=False):
+            compressed_files.append(compressed)
+        pool.map(verify, compressed_files)
+    finally:
+        pool.close()
+        pool.join()
+
+        # Remove the compressed files even if the verification failed
+        if delete:
+            for compressed in compressed_files:
+                os.remove(compressed)
 
-        if archiver:
-            args = archiver + " " + options + " " + file_path
-        else:
-            args = decompressor + " " + options + " " + file_path
-        child_process = subprocess.Popen(args, shell=True,
-                                         stderr=subprocess.PIPE,
-                                         stdout=tmp_file_obj)
-        child_process.wait()
-        tmp_file_obj.flush()
-        yield tmp_file_obj.name
-        tmp_file_obj.close()
+
+def _get_memory_directory(default):
+    """
+    Return the path to a writable directory on a memory-backed file-system
+    ('$XDG_RUNTIME_DIR' or '/dev/shm'), or 'default' if there is none.
+    """
+
+    for directory in (os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"):
+        if directory and os.path.isdir(directory) and \
+           os.access(directory, os.W_OK | os.X_OK):
+            return directory
+
+    return default
 
 
 def _do_test(image, image_size, delete=True):
@@ -149,20 +363,29 @@ def _do_test(image, image_size, delete=True):
     # Put the temporary files in the directory with the image
     directory = os.path.dirname(image)
 
-    # Create and open a temporary file for a copy of the image
-    f_copy = tempfile.NamedTemporaryFile("wb+", prefix=prefix,
-                                         delete=delete, dir=directory,
-                                         suffix=".copy")
-
-    # Create and open 2 temporary files for the bmap
-    f_bmap1 = tempfile.NamedTemporaryFile("w+", prefix=prefix,
-                                          delete=delete, dir=directory,
-                                          suffix=".bmap1")
-    f_bmap2 = tempfile.NamedTemporaryFile("w+", prefix=prefix,
-                                          delete=delete, dir=directory,
-                                          suffix=".bmap2")
-
-    image_chksum = helpers.calculate_chksum(image)
+    # Create and open a temporary file for a copy of the image. It has to be
+    # on the same file-system as the image, otherwise '_compare_holes()' may
+    # see different holes because of different block sizes. The same file is
+    # re-used for all the copies: 'copy_and_verify_image()' truncates it.
+    f_copy = tempfile.NamedTemporaryFile("wb+", helpers.BUFSIZE,
+                                         prefix=prefix, delete=delete,
+                                         dir=directory, suffix=".copy")
+
+    # Create and open 2 temporary files for the bmap. Unlike the copy, they do
+    # not have to share the file-system with the image, so keep them in memory
+    # if possible.
+    bmap_directory = _get_memory_directory(directory)
+    f_bmap1 = tempfile.NamedTemporaryFile("w+", helpers.BUFSIZE,
+                                          prefix=prefix, delete=delete,
+                                          dir=bmap_directory, suffix=".bmap1")
+    f_bmap2 = tempfile.NamedTemporaryFile("w+", helpers.BUFSIZE,
+                                          prefix=prefix, delete=delete,
+                                          dir=bmap_directory, suffix=".bmap2")
+
+    # Open the image only once for calculating its checksum and for the passes
+    # which use file objects
+    f_image = open(image, "rb", helpers.BUFSIZE)
+    image_chksum = helpers.calculate_chksum(f_image)
 
     #
     # Pass 1: generate the bmap, copy and compare
@@ -183,33 +406,26 @@ def _do_test(image, image_size, delete=True):
     # Pass 2: same as pass 1, but use file objects instead of paths
     #
 
-    creator = BmapCreate.BmapCreate(image, f_bmap2)
+    creator = BmapCreate.BmapCreate(f_image, f_bmap2)
     creator.generate()
     helpers.copy_and_verify_image(image, f_copy.name, f_bmap2.name,
                                   image_chksum, image_size)
     _compare_holes(image, f_copy.name)
 
-    # Make sure the bmap files generated at pass 1 and pass 2 are identical
-    assert filecmp.cmp(f_bmap1.name, f_bmap2.name, False)
+    # Make sure the bmap files generated at pass 1 and pass 2 are identical.
+    # Bmap files are small, so just compare their contents in memory.
+    with open(f_bmap1.name, "rb") as f_cmp:
+        bmap1 = f_cmp.read()
+    with open(f_bmap2.name, "rb") as f_cmp:
+        bmap2 = f_cmp.read()
+    assert bmap1 == bmap2
 
     #
-    # Pass 3: test compressed files copying with bmap
+    # Pass 3: test compressed files copying with and without bmap
     #
 
-    for compressed in _generate_compressed_files(image, delete=delete):
-        helpers.copy_and_verify_image(compressed, f_copy.name,
-                                      f_bmap1.name, image_chksum, image_size)
-
-        # Test without setting the size
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, None)
-
-        # Append a "file:" prefixe to make BmapCopy use urllib
-        compressed = "file:" + compressed
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, image_size)
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, None)
+    _verify_compressed_files(image, f_bmap1.name, image_chksum, image_size,
+                             delete=delete)
 
     #
     # Pass 5: copy without bmap and make sure it is identical to the original
@@ -219,23 +435,7 @@ def _do_test(image, image_size, delete=True):
                                   image_size)
     helpers.copy_and_verify_image(image, f_copy.name, None, image_chksum, None)
 
-    #
-    # Pass 6: test compressed files copying without bmap
-    #
-
-    for compressed in _generate_compressed_files(image, delete=delete):
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, image_size)
-
-        # Test without setting the size
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, None)
-
-        # Append a "file:" prefix to make BmapCopy use urllib
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, image_size)
-        helpers.copy_and_verify_image(compressed, f_copy.name, f_bmap1.name,
-                                      image_chksum, None)
+    f_image.close()
 
     # Close temporary files, which will also remove them
     f_copy.close()
@@ -243,6 +443,16 @@ def _do_test(image, image_size, delete=True):
     f_bmap2.close()
 
 
+@contextlib.contextmanager
+def _no_subtest(**_):
+    """
+    A replacement for 'unittest.TestCase.subTest()' for the 'unittest'
+    versions which do not have it (Python 2.7 without 'unittest2').
+    """
+
+    yield
+
+
 class TestCreateCopy(unittest.TestCase):
     """
     The test class for this unit tests. Basically executes the '_do_test()'
@@ -262,6 +472,10 @@ class TestCreateCopy(unittest.TestCase):
 
         iterator = helpers.generate_test_files(delete=delete,
                                                directory=directory)
+        # Test every image in its own sub-test, so that one failing image does
+        # not hide failures of the others
+        subtest = getattr(self, "subTest", _no_subtest)
         for f_image, image_size, _, _ in iterator:
-            assert image_size == os.path.getsize(f_image.name)
-            _do_test(f_image.name, image_size, delete=delete)
+            with subtest(image=f_image.name):
+                assert image_size == os.path.getsize(f_image.name)
+                _do_test(f_image.name, image_size, delete=delete)